@@ -5,6 +5,11 @@ import logging
 import sys
 import bisect
 import itertools
+import base64
+import hashlib
+import hmac
+import re
+import time
 
 import slack
 
@@ -14,6 +19,7 @@ CWD = os.path.dirname(os.path.realpath(__file__))
 sys.path.insert(0, os.path.join(CWD, 'lib'))
 
 from kayako import Kayako       # noqa: E402
+from tenants import DEFAULT_TENANT, load_tenants, parse_tenants       # noqa: E402
 
 LOG_LEVEL = logging.INFO
 boto3.set_stream_logger('', LOG_LEVEL)
@@ -24,55 +30,347 @@ logger.setLevel(LOG_LEVEL)
 session = boto3.Session()
 s3 = session.client('s3')
 
-kayako = Kayako(os.getenv('CANOE_KAYAKO_API_URL'),
-                os.getenv('CANOE_KAYAKO_API_KEY'),
-                os.getenv('CANOE_KAYAKO_SECRET_KEY'))
+# Kayako clients keyed by tenant credentials, tenants sharing a helpdesk share
+# a single HTTP session
+kayako_clients = {}
 
-SLACK_CHANNEL_ID = os.getenv('CANOE_SLACK_CHANNEL_ID')
 slack_client = slack.WebClient(token=os.getenv('CANOE_SLACK_API_TOKEN'))
 
+# tenants loaded from Secrets Manager, refreshed every few minutes
+TENANTS_CACHE_SECONDS = 300
+tenants_cache = {}
+
+# a ticket change is checked this long after its first callback, callbacks
+# arriving while that check is pending are covered by it
+TICKET_CHANGE_DEDUP_SECONDS = 60
+
+# every ticket of a callback is claimed with a separate DynamoDB call
+MAX_TICKET_CHANGE_IDS = 100
+
+# tenants' Kayako budgets are spent at most this far ahead, SQS can't delay a
+# message for longer than 15 minutes
+KAYAKO_BUDGET_MINUTES = 15
+
 
 def seed_handler(event, context):
     if event.get('type', None) != 'seed':
         logger.warning(f'unexpected event: {event}')
         return
 
-    project_name = os.getenv('CANOE_ROOT_PROJECT_NAME')
-    dep_ids = list_relevant_department_ids(kayako, project_name)
     queue_url = os.getenv('CANOE_CHECK_DEPARTMENT_QUEUE_URL')
     sqs = session.resource('sqs')
     queue = sqs.Queue(queue_url)
-    messages = sqs_messages(dep_ids)
+    for tenant in tenant_registry():
+        try:
+            seed_tenant(queue, tenant)
+        except Exception:
+            logger.exception(f'failed to seed tenant {tenant.name}')
+
+
+def seed_tenant(queue, tenant):
+    kayako = kayako_client(tenant)
+    dep_ids = list(list_relevant_department_ids(kayako, tenant.root_project_name))
+    dep_ids = rotate_department_ids(dep_ids, seed_cursor(tenant))
+    messages, overflow = budgeted_messages(sqs_messages(dep_ids, tenant), tenant, time.time())
+    if overflow:
+        save_seed_cursor(tenant, overflow[0]['Id'])
     if not messages:
-        logger.warning('no messages to send')
+        logger.warning(f'no messages to send for tenant {tenant.name}')
         return
 
     send_messages(queue, messages)
 
 
+# departments that didn't fit in the budget start the next seed
+def rotate_department_ids(dep_ids, first_dep_id):
+    if first_dep_id not in dep_ids:
+        return dep_ids
+    index = dep_ids.index(first_dep_id)
+    return dep_ids[index:] + dep_ids[:index]
+
+
+def seed_cursor(tenant):
+    if not tenant.requests_per_minute:
+        return None
+    response = kayako_budget_table().get_item(Key={'budget_key': f'{tenant.name}/seed'})
+    return response.get('Item', {}).get('department_id')
+
+
+def save_seed_cursor(tenant, department_id):
+    kayako_budget_table().put_item(
+        Item={'budget_key': f'{tenant.name}/seed', 'department_id': department_id})
+
+
+def tenant_registry():
+    secret_id = os.getenv('CANOE_TENANTS_SECRET')
+    if not secret_id:
+        return load_tenants(os.environ)
+
+    loaded_at, tenants = tenants_cache.get(secret_id, (0, None))
+    if time.time() - loaded_at >= TENANTS_CACHE_SECONDS:
+        secret = session.client('secretsmanager').get_secret_value(SecretId=secret_id)
+        tenants = parse_tenants(secret['SecretString'])
+        tenants_cache[secret_id] = (time.time(), tenants)
+    return tenants
+
+
+def kayako_client(tenant):
+    credentials = tenant.kayako_credentials
+    if credentials not in kayako_clients:
+        kayako_clients[credentials] = Kayako(*credentials)
+    return kayako_clients[credentials]
+
+
 def send_messages(queue, items, batch_size=10):
+    failed_ids = []
     iter_items = [iter(items)] * batch_size
     for batch in itertools.zip_longest(*iter_items, fillvalue=None):
         batch = list(filter(None, batch))
-        queue.send_messages(Entries=batch)
+        response = queue.send_messages(Entries=batch)
+        failed_ids.extend(entry['Id'] for entry in response.get('Failed', []))
+    return failed_ids
 
 
 def distribute_departments_tickets_handler(event, context):
-    ticket_ids = []
+    tenants = tenant_registry()
+    queue_url = os.getenv('CANOE_CHECK_TICKET_QUEUE_URL')
+    sqs = session.resource('sqs')
+    queue = sqs.Queue(queue_url)
 
     for record in event['Records']:
         message = json.loads(record['body'])
+        tenant = tenants.get(message.get('tenant'))
         department_id = message['department_id']
-        tickets = kayako.list_open_tickets(department_id)
-        for ticket in tickets.findall('.//ticket'):
-            ticket_id = ticket.get('id')
-            ticket_ids.append(ticket_id)
+        after_ticket_id = message.get('after_ticket_id')
+        tickets = kayako_client(tenant).list_open_tickets(department_id)
+        ticket_ids = [ticket.get('id') for ticket in tickets.findall('.//ticket')]
+        if after_ticket_id:
+            ticket_ids = [ticket_id for ticket_id in ticket_ids if int(ticket_id) > int(after_ticket_id)]
+        messages = check_ticket_messages(ticket_ids, tenant)
+        messages, overflow = budgeted_messages(messages, tenant, time.time())
+        send_messages(queue, messages)
+        if overflow:
+            if messages:
+                after_ticket_id = messages[-1]['Id']
+            continue_department(department_id, tenant, after_ticket_id)
 
-    queue_url = os.getenv('CANOE_CHECK_TICKET_QUEUE_URL')
+
+# tickets over the budget are checked when the department is distributed
+# again, starting after the last ticket that was enqueued
+def continue_department(department_id, tenant, after_ticket_id):
+    queue_url = os.getenv('CANOE_CHECK_DEPARTMENT_QUEUE_URL')
     sqs = session.resource('sqs')
     queue = sqs.Queue(queue_url)
-    messages = check_ticket_messages(ticket_ids)
-    send_messages(queue, messages)
+    send_messages(queue, [
+        {
+            'Id': department_id,
+            'MessageBody': json.dumps({
+                'department_id': department_id,
+                'tenant': tenant.name,
+                'after_ticket_id': after_ticket_id
+            }),
+            'DelaySeconds': KAYAKO_BUDGET_MINUTES * 60
+        }
+    ])
+
+
+def budgeted_messages(messages, tenant, now):
+    if not tenant.requests_per_minute:
+        return messages, []
+
+    delays = reserve_kayako_requests(kayako_budget_table(), tenant, len(messages), now)
+    if len(delays) < len(messages):
+        logger.warning(f'tenant {tenant.name} is over its Kayako budget, '
+                       f'{len(messages) - len(delays)} messages are deferred')
+    for message, delay in zip(messages, delays):
+        message['DelaySeconds'] = delay
+    return messages[:len(delays)], messages[len(delays):]
+
+
+def kayako_budget_table():
+    return session.resource('dynamodb').Table(os.getenv('CANOE_KAYAKO_BUDGET_TABLE'))
+
+
+# every message triggers one Kayako call, the calls are counted per tenant and
+# minute in a table shared by all functions. A minute's calls are reserved at
+# once and whatever exceeds the limit is given back
+def reserve_kayako_requests(table, tenant, count, now):
+    limit = tenant.requests_per_minute
+    first_minute = int(now // 60)
+    delays = []
+    for minute in range(first_minute, first_minute + KAYAKO_BUDGET_MINUTES):
+        wanted = min(count - len(delays), limit)
+        if not wanted:
+            break
+
+        key = {'budget_key': f'{tenant.name}/{minute}'}
+        response = table.update_item(
+            Key=key,
+            UpdateExpression='ADD request_count :count SET expires_at = :expires_at',
+            ExpressionAttributeValues={
+                ':count': wanted,
+                ':expires_at': (minute + KAYAKO_BUDGET_MINUTES) * 60
+            },
+            ReturnValues='UPDATED_OLD')
+        used = int(response.get('Attributes', {}).get('request_count', 0))
+        granted = max(min(wanted, limit - used), 0)
+        if granted < wanted:
+            table.update_item(
+                Key=key,
+                UpdateExpression='ADD request_count :count',
+                ExpressionAttributeValues={':count': granted - wanted})
+        delays.extend([max(minute * 60 - int(now), 0)] * granted)
+    return delays
+
+
+def ticket_change_handler(event, context):
+    tenants = tenant_registry()
+    body = request_body(event)
+    payload = ticket_change_payload(body)
+    signature = request_header(event, 'X-Canoe-Signature')
+    tenant = ticket_change_tenant(tenants, payload)
+    secret = os.getenv('CANOE_WEBHOOK_SECRET')
+    if tenant is not None:
+        secret = tenant.webhook_secret or secret
+    # nothing about the payload is revealed until the caller is authenticated
+    if (tenant is None and payload is not None) or not is_valid_signature(secret, body, signature):
+        logger.warning('ticket change with invalid signature')
+        return http_response(401, {'error': 'invalid signature'})
+
+    try:
+        ticket_ids = changed_ticket_ids(payload)
+    except (ValueError, KeyError, TypeError):
+        logger.warning(f'unexpected ticket change: {body}')
+        return http_response(400, {'error': 'invalid payload'})
+
+    table = session.resource('dynamodb').Table(os.getenv('CANOE_TICKET_CHANGES_TABLE'))
+    ticket_ids = claim_ticket_changes(table, tenant, ticket_ids, time.time())
+    if ticket_ids:
+        queue_url = os.getenv('CANOE_CHECK_TICKET_QUEUE_URL')
+        sqs = session.resource('sqs')
+        queue = sqs.Queue(queue_url)
+        messages = check_ticket_messages(ticket_ids, tenant)
+        messages, overflow = budgeted_messages(messages, tenant, time.time())
+        overflow_ids = [message['Id'] for message in overflow]
+        release_ticket_changes(table, tenant, overflow_ids)
+        for message in messages:
+            message['DelaySeconds'] = max(message.get('DelaySeconds', 0), TICKET_CHANGE_DEDUP_SECONDS)
+        try:
+            failed_ids = send_messages(queue, messages)
+        except Exception:
+            release_ticket_changes(table, tenant, ticket_ids)
+            raise
+
+        if failed_ids:
+            logger.error(f'failed to enqueue ticket changes: {failed_ids}')
+            release_ticket_changes(table, tenant, failed_ids)
+            return http_response(503, {'error': 'failed to enqueue', 'ticket_ids': failed_ids + overflow_ids})
+
+        if overflow_ids:
+            return http_response(429, {'error': 'over budget', 'ticket_ids': overflow_ids})
+
+    return http_response(202, {'ticket_ids': ticket_ids})
+
+
+def ticket_change_payload(body):
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return None
+    if isinstance(payload, dict):
+        return payload
+
+
+# a payload that can't be parsed is verified against the shared secret and
+# then rejected as invalid, an unknown tenant can't be verified at all
+def ticket_change_tenant(tenants, payload):
+    if payload is None:
+        return None
+    try:
+        return tenants.get(payload.get('tenant'))
+    except (KeyError, TypeError):
+        return None
+
+
+def request_body(event):
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        return base64.b64decode(body).decode('utf-8')
+    return body
+
+
+def request_header(event, name):
+    headers = event.get('headers') or {}
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+
+
+def is_valid_signature(secret, body, signature):
+    if not secret or not signature:
+        return False
+
+    digest = hmac.new(secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256)
+    return hmac.compare_digest(digest.hexdigest().encode('utf-8'), signature.encode('utf-8'))
+
+
+def changed_ticket_ids(payload):
+    if 'ticket_ids' in payload:
+        ticket_ids = payload['ticket_ids']
+        if not isinstance(ticket_ids, list):
+            raise ValueError(f'invalid ticket ids: {ticket_ids}')
+    else:
+        ticket_ids = [payload['ticket_id']]
+    if len(ticket_ids) > MAX_TICKET_CHANGE_IDS:
+        raise ValueError(f'too many ticket ids: {len(ticket_ids)}')
+    return [valid_ticket_id(ticket_id) for ticket_id in ticket_ids]
+
+
+# ticket ids end up in Kayako URLs and SQS batch entry ids
+def valid_ticket_id(ticket_id):
+    if isinstance(ticket_id, bool):
+        raise ValueError(f'invalid ticket id: {ticket_id}')
+    if isinstance(ticket_id, str) and re.fullmatch('[0-9]+', ticket_id):
+        ticket_id = int(ticket_id)
+    if not isinstance(ticket_id, int) or ticket_id <= 0:
+        raise ValueError(f'invalid ticket id: {ticket_id}')
+    return str(ticket_id)
+
+
+# the conditional put lets only one of concurrent callbacks for a ticket
+# enqueue a check, until that check is due
+def claim_ticket_changes(table, tenant, ticket_ids, now, window=TICKET_CHANGE_DEDUP_SECONDS):
+    claimed_ids = []
+    for ticket_id in ticket_ids:
+        try:
+            table.put_item(
+                Item={
+                    'ticket_key': ticket_change_key(tenant, ticket_id),
+                    'expires_at': int(now) + window
+                },
+                ConditionExpression='attribute_not_exists(ticket_key) OR expires_at <= :now',
+                ExpressionAttributeValues={':now': int(now)})
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            continue
+        claimed_ids.append(ticket_id)
+    return claimed_ids
+
+
+def release_ticket_changes(table, tenant, ticket_ids):
+    for ticket_id in ticket_ids:
+        table.delete_item(Key={'ticket_key': ticket_change_key(tenant, ticket_id)})
+
+
+def ticket_change_key(tenant, ticket_id):
+    return f'{tenant.name}/{ticket_id}'
+
+
+def http_response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps(body)
+    }
 
 
 # we are including the top level department and sub departments as well
@@ -87,18 +385,20 @@ def list_relevant_department_ids(kayako, project_name):
 
 
 def check_ticket_handler(event, context):
+    tenants = tenant_registry()
     tickets_updates = []
     for record in event['Records']:
         message = json.loads(record['body'])
+        tenant = tenants.get(message.get('tenant'))
         ticket_id = message['ticket_id']
 
-        state = get_ticket_state(ticket_id)
-        ticket = kayako.get_ticket(ticket_id)
+        state = get_ticket_state(tenant, ticket_id)
+        ticket = kayako_client(tenant).get_ticket(ticket_id)
         new_posts = diff_new_posts(ticket, state)
         updates = list(ticket_updates(ticket_id, ticket, new_posts))
-        tickets_updates.extend(updates)
+        tickets_updates.extend((tenant, update) for update in updates)
         if updates:
-            save_ticket_state(ticket_id, ticket)
+            save_ticket_state(tenant, ticket_id, ticket)
 
     if not is_in_learning_mode():
         queue_url = os.getenv('CANOE_TICKETS_UPDATES_QUEUE_URL')
@@ -113,14 +413,16 @@ def is_in_learning_mode():
 
 
 def updates_notifications_handler(event, context):
+    tenants = tenant_registry()
     for record in event['Records']:
         body = json.loads(record['body'])
         if body['type'] == 'new_post':
+            tenant = tenants.get(body.get('tenant'))
             new_post = body['object']
             text = message_text(new_post)
-            blocks = message_blocks(new_post)
+            blocks = message_blocks(new_post, tenant.kayako_ui_url)
             slack_client.chat_postMessage(
-                channel=SLACK_CHANNEL_ID,
+                channel=tenant.slack_channel_id,
                 text=text,
                 blocks=blocks)
 
@@ -131,8 +433,7 @@ def message_text(new_post):
     return tmpl.format(**new_post)
 
 
-def message_blocks(new_post):
-    portal_uri = os.getenv('CANOE_KAYAKO_UI_URL')
+def message_blocks(new_post, portal_uri):
     ticket_link = '{portal_uri}?/Tickets/Ticket/View/{ticket_id}'.format(
         portal_uri=portal_uri, **new_post)
     return [
@@ -153,9 +454,9 @@ def message_blocks(new_post):
     ]
 
 
-def save_ticket_state(ticket_id, ticket):
+def save_ticket_state(tenant, ticket_id, ticket):
     bucket = tickets_state_bucket()
-    key = ticket_state_key(ticket_id)
+    key = ticket_state_key(tenant, ticket_id)
     xml = ElementTree.tostring(ticket, encoding="utf-8")
     s3.put_object(Bucket=bucket, Key=key, Body=xml)
 
@@ -196,14 +497,14 @@ def latest_post_dateline(state):
     return max([int(dl.text) for dl in dateline_els])
 
 
-def get_ticket_state(ticket_id):
-    state = read_ticket_state(ticket_id)
+def get_ticket_state(tenant, ticket_id):
+    state = read_ticket_state(tenant, ticket_id)
     if state:
         return ElementTree.parse(state)
 
 
-def read_ticket_state(ticket_id):
-    key = ticket_state_key(ticket_id)
+def read_ticket_state(tenant, ticket_id):
+    key = ticket_state_key(tenant, ticket_id)
     bucket = tickets_state_bucket()
 
     try:
@@ -213,29 +514,33 @@ def read_ticket_state(ticket_id):
         logger.info(f'No state found {bucket}/{key}')
 
 
-def ticket_state_key(ticket_id):
-    return f'tickets/{ticket_id}.xml'
+# ticket ids are only unique within a helpdesk, the default tenant keeps the
+# original layout so existing state is not lost
+def ticket_state_key(tenant, ticket_id):
+    if tenant.name == DEFAULT_TENANT:
+        return f'tickets/{ticket_id}.xml'
+    return f'tenants/{tenant.name}/tickets/{ticket_id}.xml'
 
 
 def tickets_state_bucket():
     return os.getenv('CANOE_TICKETS_STATE_BUCKET')
 
 
-def sqs_messages(department_ids):
+def sqs_messages(department_ids, tenant):
     return [
         {
             'Id': dep_id,
-            'MessageBody': json.dumps({'department_id': dep_id})
+            'MessageBody': json.dumps({'department_id': dep_id, 'tenant': tenant.name})
         }
         for dep_id in department_ids
     ]
 
 
-def check_ticket_messages(ticket_ids):
+def check_ticket_messages(ticket_ids, tenant):
     return [
         {
             'Id': ticket_id,
-            'MessageBody': json.dumps({'ticket_id': ticket_id})
+            'MessageBody': json.dumps({'ticket_id': ticket_id, 'tenant': tenant.name})
         }
         for ticket_id in ticket_ids
     ]
@@ -247,8 +552,9 @@ def tickets_updates_messages(updates):
             'Id': str(index),
             'MessageBody': json.dumps({
                 'type': 'new_post',
+                'tenant': tenant.name,
                 'object': update
             })
         }
-        for index, update in enumerate(updates)
+        for index, (tenant, update) in enumerate(updates)
     ]
@@ -0,0 +1,88 @@
+import json
+
+DEFAULT_TENANT = 'default'
+
+REQUIRED_FIELDS = ('name', 'root_project_name', 'kayako_api_url', 'kayako_api_key',
+                   'kayako_secret_key', 'kayako_ui_url', 'slack_channel_id')
+OPTIONAL_FIELDS = ('requests_per_minute', 'webhook_secret')
+
+
+class Tenant:
+
+    def __init__(self, name, root_project_name, kayako_api_url, kayako_api_key,
+                 kayako_secret_key, kayako_ui_url, slack_channel_id,
+                 requests_per_minute=None, webhook_secret=None):
+        self.name = name
+        self.root_project_name = root_project_name
+        self.kayako_api_url = kayako_api_url
+        self.kayako_api_key = kayako_api_key
+        self.kayako_secret_key = kayako_secret_key
+        self.kayako_ui_url = kayako_ui_url
+        self.slack_channel_id = slack_channel_id
+        self.requests_per_minute = requests_per_minute
+        self.webhook_secret = webhook_secret
+
+    @property
+    def kayako_credentials(self):
+        return (self.kayako_api_url, self.kayako_api_key, self.kayako_secret_key)
+
+
+class TenantRegistry:
+
+    def __init__(self, tenants):
+        self._tenants = {}
+        for tenant in tenants:
+            if tenant.name in self._tenants:
+                raise ValueError(f'duplicate tenant: {tenant.name}')
+            self._tenants[tenant.name] = tenant
+
+    def __iter__(self):
+        return iter(self._tenants.values())
+
+    def __len__(self):
+        return len(self._tenants)
+
+    # messages queued before tenants were introduced carry no tenant name,
+    # they belong to the only configured tenant
+    def get(self, name=None):
+        if name is None and len(self._tenants) == 1:
+            return next(iter(self._tenants.values()))
+        return self._tenants[name or DEFAULT_TENANT]
+
+
+def load_tenants(environ):
+    config = environ.get('CANOE_TENANTS')
+    if config:
+        return parse_tenants(config)
+    return TenantRegistry([default_tenant(environ)])
+
+
+def parse_tenants(config):
+    return TenantRegistry(tenant_from_config(tenant) for tenant in json.loads(config))
+
+
+def tenant_from_config(config):
+    name = config.get('name')
+    missing = [field for field in REQUIRED_FIELDS if not config.get(field)]
+    if missing:
+        raise ValueError(f"tenant {name} is missing {', '.join(missing)}")
+    unknown = sorted(set(config) - set(REQUIRED_FIELDS) - set(OPTIONAL_FIELDS))
+    if unknown:
+        raise ValueError(f"tenant {name} has unknown fields {', '.join(unknown)}")
+    requests_per_minute = config.get('requests_per_minute')
+    if requests_per_minute is not None and (
+            type(requests_per_minute) is not int or requests_per_minute <= 0):
+        raise ValueError(f'tenant {name} requests_per_minute must be a positive integer')
+    return Tenant(**config)
+
+
+# single tenant deployments are configured with plain environment variables
+def default_tenant(environ):
+    return Tenant(
+        name=DEFAULT_TENANT,
+        root_project_name=environ.get('CANOE_ROOT_PROJECT_NAME'),
+        kayako_api_url=environ.get('CANOE_KAYAKO_API_URL'),
+        kayako_api_key=environ.get('CANOE_KAYAKO_API_KEY'),
+        kayako_secret_key=environ.get('CANOE_KAYAKO_SECRET_KEY'),
+        kayako_ui_url=environ.get('CANOE_KAYAKO_UI_URL'),
+        slack_channel_id=environ.get('CANOE_SLACK_CHANNEL_ID'))
@@ -2,6 +2,9 @@
 
 import io
 import os
+import hmac
+import json
+import hashlib
 import sys
 import pytest
 from unittest.mock import Mock
@@ -11,6 +14,7 @@ CWD = os.path.dirname(os.path.realpath(__file__)) + "/../../"
 sys.path.insert(0, os.path.join(CWD, ''))
 
 from canoe import app # noqa
+import tenants # noqa
 
 
 @pytest.fixture()
@@ -139,19 +143,232 @@ def test_seed_handler(seed_event, context, kayako, monkeypatch):
     monkeypatch.setattr('canoe.app.session', session)
     sqs = session.resource.return_value
     queue = sqs.Queue.return_value
-    monkeypatch.setattr('canoe.app.kayako', kayako)
+    queue.send_messages.return_value = {}
+    monkeypatch.setattr('canoe.app.kayako_client', lambda tenant: kayako)
     monkeypatch.setenv('CANOE_ROOT_PROJECT_NAME', 'Project Name')
     app.seed_handler(seed_event, context)
     queue.send_messages.assert_called_with(
         Entries=[
-            {'Id': '1', 'MessageBody': '{"department_id": "1"}'},
-            {'Id': '2', 'MessageBody': '{"department_id": "2"}'},
-            {'Id': '3', 'MessageBody': '{"department_id": "3"}'},
-            {'Id': '4', 'MessageBody': '{"department_id": "4"}'}
+            {'Id': '1', 'MessageBody': '{"department_id": "1", "tenant": "default"}'},
+            {'Id': '2', 'MessageBody': '{"department_id": "2", "tenant": "default"}'},
+            {'Id': '3', 'MessageBody': '{"department_id": "3", "tenant": "default"}'},
+            {'Id': '4', 'MessageBody': '{"department_id": "4", "tenant": "default"}'}
         ]
     )
 
 
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class FakeTicketChangesTable:
+
+    def __init__(self):
+        self.items = {}
+        self.meta = Mock()
+        self.meta.client.exceptions.ConditionalCheckFailedException = ConditionalCheckFailedException
+
+    def put_item(self, Item, ConditionExpression, ExpressionAttributeValues):
+        item = self.items.get(Item['ticket_key'])
+        if item and item['expires_at'] > ExpressionAttributeValues[':now']:
+            raise ConditionalCheckFailedException()
+        self.items[Item['ticket_key']] = Item
+
+    def delete_item(self, Key):
+        self.items.pop(Key['ticket_key'], None)
+
+
+class FakeBudgetTable:
+
+    def __init__(self):
+        self.items = {}
+        self.meta = Mock()
+        self.meta.client.exceptions.ConditionalCheckFailedException = ConditionalCheckFailedException
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ReturnValues=None):
+        self.calls = getattr(self, 'calls', 0) + 1
+        item = self.items.setdefault(Key['budget_key'], {})
+        old = dict(item)
+        item['request_count'] = item.get('request_count', 0) + ExpressionAttributeValues[':count']
+        return {'Attributes': old} if old and ReturnValues == 'UPDATED_OLD' else {}
+
+    def get_item(self, Key):
+        item = self.items.get(Key['budget_key'])
+        return {'Item': item} if item else {}
+
+    def put_item(self, Item):
+        self.items[Item['budget_key']] = Item
+
+
+def sqs_session(monkeypatch, table=None):
+    session = Mock()
+    monkeypatch.setattr('canoe.app.session', session)
+    queue = Mock(**{'send_messages.return_value': {}})
+    resources = {'dynamodb': Mock(**{'Table.return_value': table}), 'sqs': Mock(**{'Queue.return_value': queue})}
+    session.resource.side_effect = resources.get
+    return queue
+
+
+@pytest.fixture()
+def tenants_config():
+    return json.dumps([
+        {
+            'name': 'team-a',
+            'root_project_name': 'Project Name',
+            'kayako_api_url': 'https://kayako-a.com',
+            'kayako_api_key': 'key-a',
+            'kayako_secret_key': 'secret-a',
+            'kayako_ui_url': 'https://kayako-a.com/staff',
+            'slack_channel_id': 'CHANNELA'
+        },
+        {
+            'name': 'team-b',
+            'root_project_name': 'Project Name',
+            'kayako_api_url': 'https://kayako-a.com',
+            'kayako_api_key': 'key-a',
+            'kayako_secret_key': 'secret-a',
+            'kayako_ui_url': 'https://kayako-a.com/staff',
+            'slack_channel_id': 'CHANNELB',
+            'requests_per_minute': 2,
+            'webhook_secret': 'team-b-secret'
+        }
+    ])
+
+
+def test_seed_handler_fans_out_across_tenants(seed_event, context, kayako, tenants_config, monkeypatch):
+    queue = sqs_session(monkeypatch, FakeBudgetTable())
+    monkeypatch.setattr('canoe.app.time.time', lambda: 6000)
+    clients = []
+    monkeypatch.setattr('canoe.app.kayako_client', lambda tenant: clients.append(tenant.name) or kayako)
+    monkeypatch.setenv('CANOE_TENANTS', tenants_config)
+    app.seed_handler(seed_event, context)
+    assert clients == ['team-a', 'team-b']
+    assert queue.send_messages.call_count == 2
+    queue.send_messages.assert_called_with(
+        Entries=[
+            {'Id': '1', 'MessageBody': '{"department_id": "1", "tenant": "team-b"}', 'DelaySeconds': 0},
+            {'Id': '2', 'MessageBody': '{"department_id": "2", "tenant": "team-b"}', 'DelaySeconds': 0},
+            {'Id': '3', 'MessageBody': '{"department_id": "3", "tenant": "team-b"}', 'DelaySeconds': 60},
+            {'Id': '4', 'MessageBody': '{"department_id": "4", "tenant": "team-b"}', 'DelaySeconds': 60}
+        ]
+    )
+
+
+def test_kayako_client_is_shared_by_credentials(tenants_config, monkeypatch):
+    monkeypatch.setattr('canoe.app.kayako_clients', {})
+    monkeypatch.setattr('canoe.app.Kayako', Mock(side_effect=lambda *args: Mock()))
+    registry = tenants.load_tenants({'CANOE_TENANTS': tenants_config})
+    team_a, team_b = registry
+    assert app.kayako_client(team_a) is app.kayako_client(team_b)
+    app.Kayako.assert_called_once_with('https://kayako-a.com', 'key-a', 'secret-a')
+
+
+def test_reserve_kayako_requests_leaves_overflow():
+    tenant = tenants.Tenant('team-b', 'Project Name', 'https://kayako-a.com', 'key', 'secret',
+                            'https://kayako-a.com/staff', 'CHANNELB', requests_per_minute=2)
+    table = FakeBudgetTable()
+    delays = app.reserve_kayako_requests(table, tenant, 40, now=6030)
+    assert delays == [0, 0] + [minute * 60 - 30 for minute in range(1, 15) for _ in range(2)]
+    assert table.calls == 15
+
+
+def test_reserve_kayako_requests_gives_back_excess():
+    tenant = tenants.Tenant('team-b', 'Project Name', 'https://kayako-a.com', 'key', 'secret',
+                            'https://kayako-a.com/staff', 'CHANNELB', requests_per_minute=10)
+    table = FakeBudgetTable()
+    table.items['team-b/100'] = {'request_count': 7}
+    delays = app.reserve_kayako_requests(table, tenant, 5, now=6000)
+    assert delays == [0, 0, 0, 60, 60]
+    assert table.items['team-b/100']['request_count'] == 10
+    assert table.items['team-b/101']['request_count'] == 2
+
+
+def test_budgeted_messages_share_budget_across_calls(tenants_config, monkeypatch):
+    table = FakeBudgetTable()
+    sqs_session(monkeypatch, table)
+    tenant = tenants.load_tenants({'CANOE_TENANTS': tenants_config}).get('team-b')
+    messages = app.check_ticket_messages([str(ticket_id) for ticket_id in range(1, 21)], tenant)
+    budgeted, overflow = app.budgeted_messages(messages, tenant, 6000)
+    assert (len(budgeted), overflow) == (20, [])
+    messages = app.check_ticket_messages([str(ticket_id) for ticket_id in range(21, 33)], tenant)
+    budgeted, overflow = app.budgeted_messages(messages, tenant, 6000)
+    assert [message['DelaySeconds'] for message in budgeted] == [600, 600, 660, 660, 720, 720, 780, 780, 840, 840]
+    assert [message['Id'] for message in overflow] == ['31', '32']
+
+
+def test_seed_handler_starts_with_departments_left_out(seed_event, context, kayako, tenants_config, monkeypatch):
+    table = FakeBudgetTable()
+    for minute in range(100, 114):
+        table.items[f'team-b/{minute}'] = {'request_count': 2}
+    queue = sqs_session(monkeypatch, table)
+    monkeypatch.setattr('canoe.app.time.time', lambda: 6000)
+    monkeypatch.setattr('canoe.app.kayako_client', lambda tenant: kayako)
+    monkeypatch.setenv('CANOE_TENANTS', json.dumps(json.loads(tenants_config)[1:]))
+    app.seed_handler(seed_event, context)
+    assert [entry['Id'] for entry in queue.send_messages.call_args[1]['Entries']] == ['1', '2']
+    table.items['team-b/114'] = {'request_count': 0}
+    app.seed_handler(seed_event, context)
+    assert [entry['Id'] for entry in queue.send_messages.call_args[1]['Entries']] == ['3', '4']
+    table.items['team-b/114'] = {'request_count': 0}
+    table.items['team-b/113'] = {'request_count': 0}
+    app.seed_handler(seed_event, context)
+    assert [entry['Id'] for entry in queue.send_messages.call_args[1]['Entries']] == ['1', '2', '3', '4']
+
+
+@pytest.mark.parametrize('invalid', [
+    {'slack_channel_id': None},
+    {'request_per_minute': 60},
+    {'requests_per_minute': '60'},
+    {'requests_per_minute': 0},
+    {'requests_per_minute': True},
+])
+def test_load_tenants_rejects_invalid_config(tenants_config, invalid):
+    config = json.loads(tenants_config)
+    config[0].update(invalid)
+    with pytest.raises(ValueError):
+        tenants.load_tenants({'CANOE_TENANTS': json.dumps(config)})
+
+
+def test_load_tenants_rejects_duplicate_names(tenants_config):
+    config = json.loads(tenants_config)
+    with pytest.raises(ValueError):
+        tenants.load_tenants({'CANOE_TENANTS': json.dumps(config + config[:1])})
+
+
+def test_tenant_registry_from_secret(tenants_config, monkeypatch):
+    session = Mock()
+    monkeypatch.setattr('canoe.app.session', session)
+    monkeypatch.setattr('canoe.app.tenants_cache', {})
+    monkeypatch.setenv('CANOE_TENANTS_SECRET', 'arn:aws:secretsmanager:tenants')
+    secretsmanager = session.client.return_value
+    secretsmanager.get_secret_value.return_value = {'SecretString': tenants_config}
+    assert [tenant.name for tenant in app.tenant_registry()] == ['team-a', 'team-b']
+    assert [tenant.name for tenant in app.tenant_registry()] == ['team-a', 'team-b']
+    session.client.assert_called_with('secretsmanager')
+    secretsmanager.get_secret_value.assert_called_once_with(SecretId='arn:aws:secretsmanager:tenants')
+
+
+def test_load_tenants_defaults_to_environment():
+    registry = tenants.load_tenants({
+        'CANOE_ROOT_PROJECT_NAME': 'Project Name',
+        'CANOE_KAYAKO_API_URL': 'https://kayako-srv.com',
+        'CANOE_SLACK_CHANNEL_ID': 'PROJECTID'
+    })
+    tenant = registry.get()
+    assert len(registry) == 1
+    assert tenant is registry.get('default')
+    assert tenant.root_project_name == 'Project Name'
+    assert tenant.slack_channel_id == 'PROJECTID'
+
+
+def test_ticket_state_key(tenants_config):
+    registry = tenants.load_tenants({'CANOE_TENANTS': tenants_config})
+    default = tenants.Tenant('default', 'Project Name', 'https://kayako-srv.com', 'key', 'secret',
+                             'https://kayako-srv.com', 'PROJECTID')
+    assert app.ticket_state_key(default, '273') == 'tickets/273.xml'
+    assert app.ticket_state_key(registry.get('team-a'), '273') == 'tenants/team-a/tickets/273.xml'
+
+
 @pytest.fixture()
 def sqs_departments_event():
     return {
@@ -169,16 +386,241 @@ def test_distribute_departments_tickets_handler(
     monkeypatch.setattr('canoe.app.session', session)
     sqs = session.resource.return_value
     queue = sqs.Queue.return_value
-    monkeypatch.setattr('canoe.app.kayako', kayako)
+    queue.send_messages.return_value = {}
+    monkeypatch.setattr('canoe.app.kayako_client', lambda tenant: kayako)
     app.distribute_departments_tickets_handler(sqs_departments_event, context)
     queue.send_messages.assert_called_with(
         Entries=[
-            {'Id': '273', 'MessageBody': '{"ticket_id": "273"}'},
-            {'Id': '274', 'MessageBody': '{"ticket_id": "274"}'}
+            {'Id': '273', 'MessageBody': '{"ticket_id": "273", "tenant": "default"}'},
+            {'Id': '274', 'MessageBody': '{"ticket_id": "274", "tenant": "default"}'}
         ]
     )
 
 
+def test_distribute_departments_tickets_handler_for_tenant(context, kayako, tenants_config, monkeypatch):
+    queue = sqs_session(monkeypatch, FakeBudgetTable())
+    monkeypatch.setattr('canoe.app.time.time', lambda: 6000)
+    monkeypatch.setattr('canoe.app.kayako_client', lambda tenant: kayako)
+    monkeypatch.setenv('CANOE_TENANTS', tenants_config)
+    event = {'Records': [{'body': '{"department_id": "2", "tenant": "team-b"}'}]}
+    app.distribute_departments_tickets_handler(event, context)
+    queue.send_messages.assert_called_with(
+        Entries=[
+            {'Id': '273', 'MessageBody': '{"ticket_id": "273", "tenant": "team-b"}', 'DelaySeconds': 0},
+            {'Id': '274', 'MessageBody': '{"ticket_id": "274", "tenant": "team-b"}', 'DelaySeconds': 0}
+        ]
+    )
+
+
+def test_distribute_departments_tickets_handler_continues_over_budget(
+        context, kayako, tenants_config, monkeypatch):
+    table = FakeBudgetTable()
+    for minute in range(100, 115):
+        table.items[f'team-b/{minute}'] = {'request_count': 1 if minute == 114 else 2}
+    queue = sqs_session(monkeypatch, table)
+    monkeypatch.setattr('canoe.app.time.time', lambda: 6000)
+    monkeypatch.setattr('canoe.app.kayako_client', lambda tenant: kayako)
+    monkeypatch.setenv('CANOE_TENANTS', tenants_config)
+    event = {'Records': [{'body': '{"department_id": "2", "tenant": "team-b"}'}]}
+    app.distribute_departments_tickets_handler(event, context)
+    tickets_call, department_call = queue.send_messages.call_args_list
+    assert tickets_call[1]['Entries'] == [
+        {'Id': '273', 'MessageBody': '{"ticket_id": "273", "tenant": "team-b"}', 'DelaySeconds': 840}
+    ]
+    continuation = department_call[1]['Entries'][0]
+    assert continuation == {
+        'Id': '2',
+        'MessageBody': '{"department_id": "2", "tenant": "team-b", "after_ticket_id": "273"}',
+        'DelaySeconds': 900
+    }
+
+    queue.send_messages.reset_mock()
+    table.items.clear()
+    app.distribute_departments_tickets_handler({'Records': [{'body': continuation['MessageBody']}]}, context)
+    queue.send_messages.assert_called_once_with(
+        Entries=[{'Id': '274', 'MessageBody': '{"ticket_id": "274", "tenant": "team-b"}', 'DelaySeconds': 0}]
+    )
+
+
+def ticket_change_event(body, secret='webhook-secret'):
+    signature = hmac.new(secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).hexdigest()
+    return {
+        'headers': {'x-canoe-signature': signature},
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+
+@pytest.fixture()
+def ticket_change_env(monkeypatch):
+    monkeypatch.setenv('CANOE_WEBHOOK_SECRET', 'webhook-secret')
+    now = [1000]
+    monkeypatch.setattr('canoe.app.time.time', lambda: now[0])
+    table = FakeTicketChangesTable()
+    queue = sqs_session(monkeypatch, table)
+    monkeypatch.setattr('canoe.app.kayako_budget_table', lambda: FakeBudgetTable())
+    return queue, table, now
+
+
+def test_ticket_change_handler(ticket_change_env, context):
+    queue, table, now = ticket_change_env
+    event = ticket_change_event('{"ticket_ids": [273, "274", 273]}')
+    response = app.ticket_change_handler(event, context)
+    assert response['statusCode'] == 202
+    assert json.loads(response['body']) == {'ticket_ids': ['273', '274']}
+    queue.send_messages.assert_called_with(
+        Entries=[
+            {'Id': '273', 'MessageBody': '{"ticket_id": "273", "tenant": "default"}', 'DelaySeconds': 60},
+            {'Id': '274', 'MessageBody': '{"ticket_id": "274", "tenant": "default"}', 'DelaySeconds': 60}
+        ]
+    )
+
+
+def test_ticket_change_handler_deduplicates_pending_checks(ticket_change_env, context):
+    queue, table, now = ticket_change_env
+    app.ticket_change_handler(ticket_change_event('{"ticket_id": 273}'), context)
+    now[0] += 59
+    response = app.ticket_change_handler(ticket_change_event('{"ticket_id": 273}'), context)
+    assert json.loads(response['body']) == {'ticket_ids': []}
+    now[0] += 1
+    response = app.ticket_change_handler(ticket_change_event('{"ticket_id": 273}'), context)
+    assert json.loads(response['body']) == {'ticket_ids': ['273']}
+    assert queue.send_messages.call_count == 2
+
+
+def test_ticket_change_burst_is_checked_after_last_change(ticket_change_env, context, kayako, monkeypatch):
+    queue, table, now = ticket_change_env
+    posts = kayako.get_ticket.return_value.findall('.//posts/post')
+    ticket = kayako.get_ticket.return_value.find('.//posts')
+    for post in posts[:2]:
+        ticket.remove(post)
+    app.ticket_change_handler(ticket_change_event('{"ticket_id": 273}'), context)
+    # a second comment lands while the first check is still pending
+    for post in posts[:2]:
+        ticket.insert(0, post)
+    now[0] += 30
+    app.ticket_change_handler(ticket_change_event('{"ticket_id": 273}'), context)
+    assert queue.send_messages.call_count == 1
+
+    s3 = Mock()
+    s3.exceptions.NoSuchKey = ConditionalCheckFailedException
+    s3.get_object.side_effect = ConditionalCheckFailedException()
+    monkeypatch.setattr('canoe.app.s3', s3)
+    monkeypatch.setattr('canoe.app.kayako_client', lambda tenant: kayako)
+    message = queue.send_messages.call_args[1]['Entries'][0]
+    app.check_ticket_handler({'Records': [{'body': message['MessageBody']}]}, context)
+    updates = [json.loads(entry['MessageBody'])['object']
+               for entry in queue.send_messages.call_args[1]['Entries']]
+    assert [update['dateline'] for update in updates] == ['1552317114', '1552418863', '1552419863']
+
+
+def test_ticket_change_handler_releases_claims_on_send_failure(ticket_change_env, context):
+    queue, table, now = ticket_change_env
+    queue.send_messages.side_effect = Exception('sqs unavailable')
+    with pytest.raises(Exception):
+        app.ticket_change_handler(ticket_change_event('{"ticket_id": 273}'), context)
+    queue.send_messages.side_effect = None
+    response = app.ticket_change_handler(ticket_change_event('{"ticket_id": 273}'), context)
+    assert json.loads(response['body']) == {'ticket_ids': ['273']}
+
+
+def test_ticket_change_handler_invalid_signature(ticket_change_env, context):
+    queue, table, now = ticket_change_env
+    event = ticket_change_event('{"ticket_id": 273}', secret='other-secret')
+    response = app.ticket_change_handler(event, context)
+    assert response['statusCode'] == 401
+    queue.send_messages.assert_not_called()
+
+
+def test_ticket_change_handler_non_ascii_signature(ticket_change_env, context):
+    queue, table, now = ticket_change_env
+    event = ticket_change_event('{"ticket_id": 273}')
+    event['headers']['x-canoe-signature'] = 'sïgnature'
+    response = app.ticket_change_handler(event, context)
+    assert response['statusCode'] == 401
+    queue.send_messages.assert_not_called()
+
+
+def test_ticket_change_handler_tenant_secret(ticket_change_env, context, tenants_config, monkeypatch):
+    queue, table, now = ticket_change_env
+    monkeypatch.setenv('CANOE_TENANTS', tenants_config)
+    body = '{"tenant": "team-b", "ticket_id": 273}'
+    response = app.ticket_change_handler(ticket_change_event(body), context)
+    assert response['statusCode'] == 401
+    response = app.ticket_change_handler(ticket_change_event(body, secret='team-b-secret'), context)
+    assert response['statusCode'] == 202
+    body = '{"tenant": "team-a", "ticket_id": 273}'
+    response = app.ticket_change_handler(ticket_change_event(body, secret='team-b-secret'), context)
+    assert response['statusCode'] == 401
+
+
+def test_ticket_change_handler_spends_tenant_budget(ticket_change_env, context, tenants_config, monkeypatch):
+    queue, table, now = ticket_change_env
+    budget_table = FakeBudgetTable()
+    for minute in range(17, 31):
+        budget_table.items[f'team-b/{minute}'] = {'request_count': 2}
+    monkeypatch.setattr('canoe.app.kayako_budget_table', lambda: budget_table)
+    monkeypatch.setenv('CANOE_TENANTS', tenants_config)
+    body = '{"tenant": "team-b", "ticket_ids": [273, 274, 275]}'
+    response = app.ticket_change_handler(ticket_change_event(body, secret='team-b-secret'), context)
+    assert response['statusCode'] == 429
+    assert json.loads(response['body'])['ticket_ids'] == ['275']
+    queue.send_messages.assert_called_once_with(
+        Entries=[
+            {'Id': '273', 'MessageBody': '{"ticket_id": "273", "tenant": "team-b"}', 'DelaySeconds': 60},
+            {'Id': '274', 'MessageBody': '{"ticket_id": "274", "tenant": "team-b"}', 'DelaySeconds': 60}
+        ]
+    )
+    assert 'team-b/275' not in table.items
+
+
+def test_ticket_change_handler_broken_tenants_config(ticket_change_env, context, monkeypatch):
+    monkeypatch.setenv('CANOE_TENANTS', '[{"name": "team-a"')
+    with pytest.raises(ValueError):
+        app.ticket_change_handler(ticket_change_event('{"ticket_id": 273}'), context)
+
+
+@pytest.mark.parametrize('body', ['{"tenant": "team-c", "ticket_id": 273}', '{"ticket_id": 273'])
+def test_ticket_change_handler_unauthenticated_payload(ticket_change_env, context, body):
+    queue, table, now = ticket_change_env
+    response = app.ticket_change_handler(ticket_change_event(body, secret='other-secret'), context)
+    assert response['statusCode'] == 401
+    response = app.ticket_change_handler(ticket_change_event('{"tenant": "team-c", "ticket_id": 273}'), context)
+    assert response['statusCode'] == 401
+    queue.send_messages.assert_not_called()
+
+
+def test_ticket_change_handler_releases_failed_entries(ticket_change_env, context):
+    queue, table, now = ticket_change_env
+    queue.send_messages.return_value = {'Failed': [{'Id': '274', 'Code': 'InternalError'}]}
+    response = app.ticket_change_handler(ticket_change_event('{"ticket_ids": [273, 274]}'), context)
+    assert response['statusCode'] == 503
+    assert json.loads(response['body'])['ticket_ids'] == ['274']
+    queue.send_messages.return_value = {}
+    response = app.ticket_change_handler(ticket_change_event('{"ticket_ids": [273, 274]}'), context)
+    assert json.loads(response['body']) == {'ticket_ids': ['274']}
+
+
+@pytest.mark.parametrize('body', [
+    json.dumps({'ticket_ids': list(range(1, 102))}),
+    '{"ticket_id": 273',
+    '{"id": 273}',
+    '{"ticket_ids": "273"}',
+    '{"ticket_ids": [27.3]}',
+    '{"ticket_ids": ["27.3"]}',
+    '{"ticket_id": "abc"}',
+    '{"ticket_id": 0}',
+    '{"ticket_id": -1}',
+    '{"ticket_id": true}',
+    '[273]',
+])
+def test_ticket_change_handler_invalid_payload(ticket_change_env, context, body):
+    queue, table, now = ticket_change_env
+    response = app.ticket_change_handler(ticket_change_event(body), context)
+    assert response['statusCode'] == 400
+    queue.send_messages.assert_not_called()
+
+
 @pytest.fixture()
 def sqs_check_tickets_event():
     return {
@@ -242,13 +684,14 @@ def test_check_ticket_handler(
     monkeypatch.setattr('canoe.app.session', session)
     sqs = session.resource.return_value
     queue = sqs.Queue.return_value
-    monkeypatch.setattr('canoe.app.kayako', kayako)
+    queue.send_messages.return_value = {}
+    monkeypatch.setattr('canoe.app.kayako_client', lambda tenant: kayako)
     app.check_ticket_handler(sqs_check_tickets_event, context)
     queue.send_messages.assert_called_with(
         Entries=[
             {
                 'Id': '0',
-                'MessageBody': '{"type": "new_post", "object": {"dateline": "1552419863", "fullname": "Sender FullName (customer)", "email": "customer-email@customer.com", "contents": "Thanks mate\\n\\n                    ", "displayid": "CYA-293-12345", "userorganization": "Customer Name", "subject": "Mayday Mayday", "ticket_id": "273"}}'  # noqa: E501
+                'MessageBody': '{"type": "new_post", "tenant": "default", "object": {"dateline": "1552419863", "fullname": "Sender FullName (customer)", "email": "customer-email@customer.com", "contents": "Thanks mate\\n\\n                    ", "displayid": "CYA-293-12345", "userorganization": "Customer Name", "subject": "Mayday Mayday", "ticket_id": "273"}}'  # noqa: E501
             }
         ]
     )
@@ -356,6 +799,20 @@ def updates_event():
     }
 
 
+def test_updates_notifications_handler_routes_to_tenant_channel(
+        monkeypatch, slack, tenants_config, context):
+    monkeypatch.setenv('CANOE_TENANTS', tenants_config)
+    event = {
+        'Records': [
+            {
+                'body': '{"type": "new_post", "tenant": "team-b", "object": {"fullname": "Customer", "displayid": "CYA-293-12345", "subject": "Mayday Mayday", "ticket_id": "273"}}'  # noqa: E501
+            }
+        ]
+    }
+    app.updates_notifications_handler(event, context)
+    assert slack.chat_postMessage.call_args[1]['channel'] == 'CHANNELB'
+
+
 def test_updates_notifications_handler(monkeypatch, slack, updates_event, context):
     app.updates_notifications_handler(updates_event, context)
     slack.chat_postMessage.assert_called_with(